@@ -1,11 +1,13 @@
 import numpy as np
-import yaml
-import imageio
-import copy
+import math
+import shutil
 import logging
+import subprocess
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict, Any, Optional
 from pathlib import Path
-from scipy.spatial.transform import Rotation as R
 
 import gymnasium as gym
 from gymnasium import spaces
@@ -15,7 +17,7 @@ try:
     import mujoco
     import dm_control
     from dm_control import mjcf
-    from dm_control.utils import transformations
+    from dm_control.rl.control import PhysicsError
 except ImportError:
     raise ImportError(
         'MuJoCo prerequisites not installed. Please install the prerequisites '
@@ -23,6 +25,14 @@ except ImportError:
         '`pip install -e ."[mujoco]"` if installing locally.'
     )
 
+try:
+    from numba import njit as _njit
+except ImportError:
+    def _njit(*args, **kwargs):
+        # Numba is optional; without it the kernels below run as plain
+        # NumPy code
+        return lambda func: func
+
 from flygym.terrain.mujoco_terrain import \
     FlatTerrain, Ball, GappedTerrain, ExtrudingBlocksTerrain
 from flygym.util.data import mujoco_groundwalking_model_path
@@ -72,11 +82,126 @@ _default_physics_config = {
     'friction': (1, 0.005, 0.0001),
     'gravity': (0, 0, -9.81e5),
 }
+# Compiled MuJoCo models (with the ad hoc physics changes applied), keyed
+# by the configuration they were built from. Only the most recently used
+# ones are kept so that parameter sweeps do not pile up models
+_compiled_model_cache = OrderedDict()
+_compiled_model_cache_size = 8
 _default_render_config = {
-    'saved': {'window_size': (640, 480), 'playspeed': 1.0, 'fps': 60},
+    'saved': {'window_size': (640, 480), 'playspeed': 1.0, 'fps': 60,
+              'keep_in_memory': True, 'max_recorded_frames': None},
     'headless': {}
 }
+
+
+
+@lru_cache(maxsize=None)
+def _get_video_codec() -> str:
+    """Pick the H.264 encoder used to save videos: NVIDIA's hardware
+    encoder if both the FFmpeg build and the GPU support it, libx264
+    otherwise. FFmpeg is only probed once per process."""
+    try:
+        import imageio_ffmpeg
+        
+        result = subprocess.run(
+            [imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner',
+             '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=size=256x256',
+             '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10
+        )
+    except (ImportError, OSError, RuntimeError, subprocess.SubprocessError):
+        return 'libx264'
+    return 'h264_nvenc' if result.returncode == 0 else 'libx264'
+
+
+@lru_cache(maxsize=None)
+def _load_init_pose(init_pose: str) -> Dict[str, float]:
+    """Load an initial pose (joint angles in radians) by name. The YAML
+    file is parsed only once per process; the returned dictionary is
+    shared and must not be modified."""
+    import yaml
+    try:
+        # libyaml-based loader, much faster than the pure-Python one
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    
+    with open(_init_pose_lookup[init_pose]) as f:
+        return {k: np.deg2rad(v)
+                for k, v in yaml.load(f, Loader=SafeLoader)['joints'].items()}
+
+
+def _step_physics(model: mujoco.MjModel, data: mujoco.MjData, nstep: int):
+    """Advance the simulation by ``nstep`` steps in one native call.
+    Like dm_control's ``Physics.step``, the position and velocity
+    dependent quantities (including sensor readings) are brought up to
+    date with the final state."""
+    if model.opt.integrator == mujoco.mjtIntegrator.mjINT_RK4:
+        mujoco.mj_step(model, data, nstep)
+    else:
+        # mj_step1 was already run for the current state (at the end of
+        # the previous step or by mj_forward upon reset)
+        mujoco.mj_step2(model, data)
+        if nstep > 1:
+            mujoco.mj_step(model, data, nstep - 1)
+    mujoco.mj_step1(model, data)
+
+
+def _reset_data(model: mujoco.MjModel, data: mujoco.MjData,
+                qpos_idx: np.ndarray, qpos_values: np.ndarray):
+    """Reset the simulation state and set the given joint positions.
+    The derived quantities (including sensor readings) are then computed
+    in a single forward pass, with actuation disabled as in dm_control's
+    ``physics.reset_context()`` (there is no meaningful control input
+    yet)."""
+    disableflags = model.opt.disableflags
+    model.opt.disableflags = (
+        disableflags | mujoco.mjtDisableBit.mjDSBL_ACTUATION.value
+    )
+    try:
+        mujoco.mj_resetData(model, data)
+        data.qpos[qpos_idx] = qpos_values
+        mujoco.mj_forward(model, data)
+    finally:
+        model.opt.disableflags = disableflags
+
+
+@_njit(cache=True, fastmath=True)
+def _quat_to_euler_xyz(quat: np.ndarray) -> Tuple[float, float, float]:
+    """Convert a quaternion in MuJoCo's (w, x, y, z) order to Euler
+    angles (roll, pitch, yaw) about the extrinsic x, y, z axes."""
+    w, x, y, z = quat[0], quat[1], quat[2], quat[3]
+    roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = math.asin(min(max(2 * (w * y - z * x), -1.0), 1.0))
+    yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return roll, pitch, yaw
+
+
+@_njit(cache=True, fastmath=True)
+def _pack_observation(joint_sensordata: np.ndarray,
+                      cart_pos: np.ndarray,
+                      cart_vel: np.ndarray,
+                      quat: np.ndarray,
+                      ang_vel: np.ndarray,
+                      out_joints: np.ndarray,
+                      out_fly: np.ndarray) -> None:
+    """Fill the joint (3, num_dofs) and fly (4, 3) observation arrays
+    from raw sensor readings. Compiled with Numba if it is installed."""
+    # 5 sensors per DoF: pos, vel, and force from pos/vel/motor actuators
+    joint_sensordata = joint_sensordata.reshape((out_joints.shape[1], 5))
+    out_joints[0, :] = joint_sensordata[:, 0]
+    out_joints[1, :] = joint_sensordata[:, 1]
+    out_joints[2, :] = (joint_sensordata[:, 2] + joint_sensordata[:, 3] +
+                        joint_sensordata[:, 4]) * 1e-9  # convert to N
     
+    out_fly[0, :] = cart_pos
+    out_fly[1, :] = cart_vel
+    roll, pitch, yaw = _quat_to_euler_xyz(quat)
+    out_fly[2, 0] = -roll  # flip roll??
+    out_fly[2, 1] = pitch
+    out_fly[2, 2] = yaw
+    out_fly[3, :] = ang_vel
+
 
 class NeuroMechFlyMuJoCo(gym.Env):
     """A NeuroMechFly environment using MuJoCo as the physics engine.
@@ -110,6 +235,8 @@ class NeuroMechFlyMuJoCo(gym.Env):
     init_pose : str
         Which initial pose to start the simulation from. Currently only
         'default' is implemented.
+    n_substeps : int
+        Number of physics steps advanced per call to ``step``.
     action_space : Dict[str, gym.spaces.Box]
         Definition of the simulation's action space as a Gym
         environment.
@@ -148,6 +275,7 @@ class NeuroMechFlyMuJoCo(gym.Env):
                  physics_config: Dict[str, Any] = {},
                  control: str = 'position',
                  init_pose: str = 'default',
+                 n_substeps: int = 1,
                  ) -> None:
         """Initialize a MuJoCo-based NeuroMechFly environment.
 
@@ -157,8 +285,11 @@ class NeuroMechFlyMuJoCo(gym.Env):
             The rendering mode. Can be 'headless' (no graphic rendering),
             'viewer' (display rendered images as the simulation takes
             place), or 'saved' (saving the rendered video to a file under
-            ``output_dir`` at the end of the simulation). By default
-            'saved'.
+            ``output_dir`` at the end of the simulation). In 'saved' mode,
+            if ``output_dir`` is given and
+            ``render_config['keep_in_memory']`` is False, frames are
+            instead streamed to ``output_dir / 'video.mp4'`` as they are
+            rendered. By default 'saved'.
         render_config : Dict[str, Any], optional
             Rendering configuration. Allowed parameters depend on the
             rendering mode (``render_mode``). See :ref:`mujoco_config`
@@ -185,24 +316,32 @@ class NeuroMechFlyMuJoCo(gym.Env):
         init_pose : str, optional
             Which initial pose to start the simulation from. Currently only
             'default' is implemented.
+        n_substeps : int, optional
+            Number of physics steps (of ``timestep`` each) to advance per
+            call to ``step``, holding the action constant. By default 1
         """
         self.render_mode = render_mode
-        self.render_config = copy.deepcopy(_default_render_config[render_mode])
-        self.render_config.update(render_config)
+        self.render_config = {**_default_render_config[render_mode],
+                              **render_config}
         self.actuated_joints = actuated_joints
         self.timestep = timestep
         if output_dir is not None:
             output_dir.mkdir(parents=True, exist_ok=True)
         self.output_dir = output_dir
         self.terrain = terrain
-        self.terrain_config = copy.deepcopy(_default_terrain_config[terrain])
-        self.terrain_config.update(terrain_config)
-        self.physics_config = copy.deepcopy(_default_physics_config)
-        self.physics_config.update(physics_config)
+        # The default configs only hold immutable values (scalars and
+        # tuples), so a shallow merge is sufficient
+        self.terrain_config = {**_default_terrain_config[terrain],
+                               **terrain_config}
+        self.physics_config = {**_default_physics_config, **physics_config}
         self.control = control
+        if not isinstance(n_substeps, (int, np.integer)) or n_substeps < 1:
+            raise ValueError(f'Invalid n_substeps: {n_substeps}')
+        self.n_substeps = n_substeps
         
         # Define action and observation spaces
         num_dofs = len(actuated_joints)
+        self._num_dofs = num_dofs
         bound = np.pi if control == 'position' else np.inf
         self.action_space = {
             'joints': spaces.Box(low=-bound, high=bound, shape=(num_dofs,))
@@ -224,20 +363,18 @@ class NeuroMechFlyMuJoCo(gym.Env):
         self.model.option.timestep = timestep
         if init_pose not in self._metadata['init_pose']:
             raise ValueError(f'Invalid init_pose: {init_pose}')
-        with open(_init_pose_lookup[init_pose]) as f:
-            init_pose = {k: np.deg2rad(v)
-                         for k, v in yaml.safe_load(f)['joints'].items()}
-        self.init_pose = {k: v for k, v in init_pose.items()
-                          if k in actuated_joints}
+        actuated_joints_set = set(actuated_joints)
+        self.init_pose = {k: v for k, v in _load_init_pose(init_pose).items()
+                          if k in actuated_joints_set}
         
         # Fix unactuated joints and define list of actuated joints
         # for joint in model.find_all('joint'):
         #     if joint.name not in actuated_joints:
         #         joint.type = 'fixed'
-        self.actuators = [
-            self.model.find('actuator', f'actuator_{control}_{joint}')
-            for joint in actuated_joints
-        ]
+        all_actuators = {actuator.name: actuator
+                         for actuator in self.model.find_all('actuator')}
+        self.actuators = [all_actuators[f'actuator_{control}_{joint}']
+                          for joint in actuated_joints]
         
         # Add sensors
         self.joint_sensors = []
@@ -308,43 +445,150 @@ class NeuroMechFlyMuJoCo(gym.Env):
             raise NotImplementedError
         
         arena.option.timestep = timestep
-        self.physics = mjcf.Physics.from_mjcf_model(arena)
+        # Compiling the MJCF model is the most expensive part of the
+        # setup, so reuse the model compiled for an earlier environment
+        # with the same configuration if there is one. Unseeded random
+        # terrains differ from one environment to the next and are never
+        # reused; neither are models configured by subclasses overriding
+        # the configuration methods (which may depend on their own state)
+        if (
+            (terrain == 'blocks' and
+             self.terrain_config['rand_seed'] is None) or
+            (type(self)._configure_physics is not
+             NeuroMechFlyMuJoCo._configure_physics) or
+            (type(self)._set_compliant_Tarsus is not
+             NeuroMechFlyMuJoCo._set_compliant_Tarsus)
+        ):
+            model_key = None
+        else:
+            model_key = (terrain,
+                         repr(sorted(self.terrain_config.items())),
+                         repr(sorted(self.physics_config.items())),
+                         tuple(actuated_joints), control, timestep)
+        if model_key in _compiled_model_cache:
+            _compiled_model_cache.move_to_end(model_key)
+            self.physics = mjcf.Physics.from_model(
+                _compiled_model_cache[model_key].copy()
+            )
+        else:
+            self.physics = mjcf.Physics.from_mjcf_model(arena)
+            self._configure_physics(arena)
+            if model_key is not None:
+                _compiled_model_cache[model_key] = self.physics.model.copy()
+                if len(_compiled_model_cache) > _compiled_model_cache_size:
+                    _compiled_model_cache.popitem(last=False)
         self.curr_time = 0
-        self._last_render_time = -np.inf
-        if render_mode != 'headless':        
+        self._curr_step = 0
+        self._next_render_step = 0
+        if render_mode != 'headless':
             self._eff_render_interval = (self.render_config['playspeed'] /
                                          self.render_config['fps'])
+            # Render every N physics steps (decided by integer step count
+            # to avoid drift from accumulating `curr_time`)
+            self._render_interval_steps = max(
+                1, round(self._eff_render_interval / timestep)
+            )
+        # Frames kept in memory (the first `_frame_i` ones are valid). If
+        # `max_recorded_frames` is set, this is an array preallocated upon
+        # the first rendered frame; otherwise frames are appended to a list
+        self._max_recorded_frames = self.render_config.get(
+            'max_recorded_frames'
+        )
         self._frames = []
+        self._frame_i = 0
+        self._frames_dropped = False
+        self._stream_video = (render_mode == 'saved' and
+                              output_dir is not None and
+                              not self.render_config['keep_in_memory'])
+        self._video_path = (output_dir / 'video.mp4'
+                            if output_dir is not None else None)
+        self._video_writer = None
+        self._video_streamed = False
+        self._pending_video_paths = []
+        self._renderer = None
         
+        self._bind_physics()
+        
+        # set init pose
+        init_pose_joints = [joint for joint in actuated_joints
+                            if joint in self.init_pose]
+        self._init_qpos_idx = self.physics.model.jnt_qposadr[
+            self._get_ids(init_pose_joints, 'joint')
+        ]
+        self._init_pose_values = np.array([self.init_pose[joint]
+                                           for joint in init_pose_joints])
+        self._set_init_pose()
+    
+    
+    def _bind_physics(self):
+        """Set up the views of ``self.physics`` used on the hot paths."""
+        # Raw MuJoCo structs
+        self._mj_model = self.physics.model.ptr
+        self._mj_data = self.physics.data.ptr
+        # Cache bindings to avoid resolving MJCF elements at every step
+        self._bound_actuators = self.physics.bind(self.actuators)
+        self._bound_joint_sensors = self.physics.bind(self.joint_sensors)
+        self._bound_body_sensors = [self.physics.bind(sensor)
+                                    for sensor in self.body_sensors]
+    
+    
+    def __getstate__(self):
+        # The views of `self.physics` and the rendering and video
+        # encoding resources cannot be pickled; they are recreated (or
+        # lazily reopened) upon unpickling
+        state = self.__dict__.copy()
+        for key in ('_mj_model', '_mj_data', '_bound_actuators',
+                    '_bound_joint_sensors', '_bound_body_sensors'):
+            del state[key]
+        state['_renderer'] = None
+        state['_video_writer'] = None
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind_physics()
+    
+    
+    def _get_ids(self, names: List[str], obj_type: str) -> np.ndarray:
+        """Get the MuJoCo indices of the named elements of the fly model
+        (names without the 'Animat/' prefix)."""
+        return np.array([
+            self.physics.model.name2id(f'Animat/{name}', obj_type)
+            for name in names
+        ], dtype=int)
+    
+    
+    def _configure_physics(self, arena: mjcf.RootElement):
+        """Apply the physics config and other adjustments to the newly
+        compiled model."""
         # Ad hoc changes to gravity, stiffness, and friction
-        for geom in [geom.name for geom in arena.find_all('geom')]:
-            if 'collision' in geom:
-                self.physics.model.geom(f'Animat/{geom}').friction = \
-                    self.physics_config['friction']
+        # (names are resolved to indices once and the underlying model
+        # arrays are modified in one go)
+        collision_geoms = [geom.name for geom in arena.find_all('geom')
+                           if geom.name is not None and
+                           'collision' in geom.name]
+        geom_ids = self._get_ids(collision_geoms, 'geom')
+        self.physics.model.geom_friction[geom_ids] = \
+            self.physics_config['friction']
         
-        for joint in self.actuated_joints:
-            if joint is not None:
-                self.physics.model.joint(f'Animat/{joint}').stiffness = \
-                    self.physics_config['joint_stiffness']
+        joint_ids = self._get_ids(
+            [joint for joint in self.actuated_joints if joint is not None],
+            'joint'
+        )
+        self.physics.model.jnt_stiffness[joint_ids] = \
+            self.physics_config['joint_stiffness']
         
         self.physics.model.opt.gravity = self.physics_config['gravity']
         
         # set complaint tarsus
         all_joints = [joint.name for joint in arena.find_all('joint')]
         self._set_compliant_Tarsus(all_joints, kp=5.0, stiff=0.0)
-        # set init pose
-        self._set_init_pose(self.init_pose)
-            
     
-    def _set_init_pose(self, init_pose: Dict[str, float]):
-        with self.physics.reset_context():
-            for i in range(len(self.actuated_joints)):
-                if ((self.actuators[i].joint.name in self.actuated_joints) and
-                        (self.actuators[i].joint.name in init_pose)):
-                    angle_0 = init_pose[self.actuators[i].joint.name]
-                    self.physics.named.data.qpos[
-                        f'Animat/{self.actuators[i].joint.name}'
-                    ] = angle_0
+    
+    def _set_init_pose(self):
+        _reset_data(self._mj_model, self._mj_data,
+                    self._init_qpos_idx, self._init_pose_values)
     
     
     def _set_compliant_Tarsus(self,
@@ -354,20 +598,23 @@ class NeuroMechFlyMuJoCo(gym.Env):
                               damping: float = 100):
         """Set the Tarsus2/3/4/5 to be compliant by setting the kp
         stifness and damping to a low value"""
-        for actuator in self.actuators:
+        actuator_ids = self._get_ids([
+            actuator.name for actuator in self.actuators
             if (('position' in actuator.name) and
-                    ('Tarsus' in actuator.name) and
-                    (not 'Tarsus1' in actuator.name)):
-                self.physics.model.actuator(
-                    f'Animat/{actuator.name}'
-                ).gainprm[0] = kp
-
-        for joint in all_joints:
-            if joint is None:
-                continue
-            if ('Tarsus' in joint) and (not 'Tarsus1' in joint):
-                self.physics.model.joint(f'Animat/{joint}').stiffness = stiff
-                self.physics.model.joint(f'Animat/{joint}').damping = damping
+                ('Tarsus' in actuator.name) and
+                (not 'Tarsus1' in actuator.name))
+        ], 'actuator')
+        self.physics.model.actuator_gainprm[actuator_ids, 0] = kp
+
+        joint_ids = self._get_ids([
+            joint for joint in all_joints
+            if ((joint is not None) and
+                ('Tarsus' in joint) and (not 'Tarsus1' in joint))
+        ], 'joint')
+        self.physics.model.jnt_stiffness[joint_ids] = stiff
+        self.physics.model.dof_damping[
+            self.physics.model.jnt_dofadr[joint_ids]
+        ] = damping
         
         self.physics.reset()
                     
@@ -385,11 +632,16 @@ class NeuroMechFlyMuJoCo(gym.Env):
             the user can override this method to return additional
             information.
         """
-        self.physics.reset()
+        # `_set_init_pose` resets the physics
         self.curr_time = 0
-        self._set_init_pose(self.init_pose)
-        self._frames = []
-        self._last_render_time = -np.inf
+        self._set_init_pose()
+        self._finish_video_stream()
+        if self._max_recorded_frames is None:
+            self._frames = []
+        self._frame_i = 0  # a preallocated frame buffer is reused
+        self._frames_dropped = False
+        self._curr_step = 0
+        self._next_render_step = 0
         return self._get_observation(), self._get_info()
     
     
@@ -413,9 +665,16 @@ class NeuroMechFlyMuJoCo(gym.Env):
             the user can override this method to return additional
             information.
         """
-        self.physics.bind(self.actuators).ctrl = action['joints']
-        self.physics.step()
-        self.curr_time += self.timestep
+        # Writing the controls through the dm_control binding marks the
+        # physics as dirty, so reading the sensors in `_get_observation`
+        # runs a forward pass. This extra pass is intentional: it is what
+        # makes the actuator forces in the observation reflect the new
+        # controls, as before the stepping was moved to the raw structs
+        self._bound_actuators.ctrl = action['joints']
+        with self.physics.check_invalid_state():
+            _step_physics(self._mj_model, self._mj_data, self.n_substeps)
+        self.curr_time += self.timestep * self.n_substeps
+        self._curr_step += self.n_substeps
         return self._get_observation(), self._get_info()
     
     
@@ -423,40 +682,68 @@ class NeuroMechFlyMuJoCo(gym.Env):
         """Call the ``render`` method to update the renderer. It should
         be called every iteration; the method will decide by itself
         whether action is required."""
-        if self.render_mode  == 'headless':
+        if self.render_mode == 'headless':
             return
-        if self.curr_time < self._last_render_time + self._eff_render_interval:
+        if self._curr_step < self._next_render_step:
             return
         if self.render_mode == 'saved':
-            width, height = self.render_config['window_size']
-            img = self.physics.render(width=width, height=height)
-            self._frames.append(img.copy())
-            self._last_render_time = self.curr_time
+            if self._renderer is None:
+                # Created once and reused so that the GL context and the
+                # scene are not set up again for every frame
+                width, height = self.render_config['window_size']
+                self._renderer = mujoco.Renderer(self._mj_model,
+                                                 height=height, width=width)
+                if self._stream_video:
+                    self._frame_buffer = np.empty((height, width, 3),
+                                                  dtype=np.uint8)
+                elif self._max_recorded_frames is not None:
+                    self._frames = np.empty(
+                        (self._max_recorded_frames, height, width, 3),
+                        dtype=np.uint8
+                    )
+            self._renderer.update_scene(self._mj_data)
+            if self._stream_video:
+                if self._video_writer is None:
+                    self._video_writer = self._get_video_writer(
+                        self._video_path
+                    )
+                    self._video_streamed = True
+                # The frame is encoded right away, so the same buffer can
+                # be rendered into every time
+                img = self._renderer.render(out=self._frame_buffer)
+                self._video_writer.append_data(img)
+            elif self._max_recorded_frames is None:
+                # `render` allocates a new array when no buffer is given
+                self._frames.append(self._renderer.render())
+                self._frame_i += 1
+            elif self._frame_i < len(self._frames):
+                self._renderer.render(out=self._frames[self._frame_i])
+                self._frame_i += 1
+            elif not self._frames_dropped:
+                logging.warning(
+                    f'{self._frame_i} frames recorded; further frames are '
+                    'dropped (see `max_recorded_frames` in `render_config`).'
+                )
+                self._frames_dropped = True
+            self._next_render_step = (self._curr_step +
+                                      self._render_interval_steps)
         else:
             raise NotImplementedError
     
     
     def _get_observation(self) -> Tuple[ObsType, Dict[str, Any]]:
-        # joint sensors
-        joint_obs = np.zeros((3, len(self.actuated_joints)))
-        joint_sensordata = self.physics.bind(self.joint_sensors).sensordata
-        for i, joint in enumerate(self.actuated_joints):
-            base_idx = i * 5
-            # pos and vel
-            joint_obs[:2, i] = joint_sensordata[base_idx:base_idx + 2]
-            # torque from pos/vel/motor actuators
-            joint_obs[2, i] = joint_sensordata[base_idx + 2:base_idx + 5].sum()
-        joint_obs[2, :] *= 1e-9  # convert to N
-        
-        # fly position and orientation
-        cart_pos = self.physics.bind(self.body_sensors[0]).sensordata
-        cart_vel = self.physics.bind(self.body_sensors[1]).sensordata
-        quat = self.physics.bind(self.body_sensors[2]).sensordata
-        # ang_pos = transformations.quat_to_euler(quat)
-        ang_pos = R.from_quat(quat).as_euler('xyz')  # explicitly use intrinsic
-        ang_pos[0] *= -1  # flip roll??
-        ang_vel = self.physics.bind(self.body_sensors[3]).sensordata
-        fly_pos = np.array([cart_pos, cart_vel, ang_pos, ang_vel])
+        # Observations are often kept by the caller across steps, so a
+        # new output buffer is allocated each time (a single one, split
+        # into the joint and fly observations)
+        obs_buffer = np.empty(3 * self._num_dofs + 12)
+        joint_obs = obs_buffer[:3 * self._num_dofs].reshape(3, self._num_dofs)
+        fly_pos = obs_buffer[3 * self._num_dofs:].reshape(4, 3)
+        _pack_observation(self._bound_joint_sensors.sensordata,
+                          self._bound_body_sensors[0].sensordata,
+                          self._bound_body_sensors[1].sensordata,
+                          self._bound_body_sensors[2].sensordata,
+                          self._bound_body_sensors[3].sensordata,
+                          joint_obs, fly_pos)
          
         return {
             'joints': joint_obs,
@@ -472,6 +759,12 @@ class NeuroMechFlyMuJoCo(gym.Env):
         ``reset()``, whichever is the latest.
         Only useful if ``render_mode`` is 'saved'.
 
+        If frames are being streamed to ``output_dir`` (see
+        ``render_mode`` in ``__init__``), the streamed video can only be
+        finalized at the end of the episode: it is copied to ``path``
+        upon the next ``reset()`` or ``close()``, and therefore also
+        includes the frames rendered after this call.
+
         Parameters
         ----------
         path : Path
@@ -483,12 +776,237 @@ class NeuroMechFlyMuJoCo(gym.Env):
         
         Path(path).parent.mkdir(parents=True, exist_ok=True)
         logging.info(f'Saving video to {path}')
-        with imageio.get_writer(path, fps=self.render_config['fps']) as writer:
-            for frame in self._frames:
+        if self._video_streamed:
+            if Path(path).resolve() != self._video_path.resolve():
+                self._pending_video_paths.append(path)
+            return
+        with self._get_video_writer(path) as writer:
+            for frame in self._frames[:self._frame_i]:
                 writer.append_data(frame)
     
     
+    def _get_video_writer(self, path: Path):
+        import imageio
+        
+        codec = _get_video_codec()
+        # imageio's `quality` translates to rate control options that
+        # NVENC does not understand; leave it to the encoder's defaults
+        quality = None if codec == 'h264_nvenc' else 5
+        return imageio.get_writer(path, fps=self.render_config['fps'],
+                                  codec=codec, quality=quality)
+    
+    
+    def _finish_video_stream(self):
+        """Finalize the video streamed during the current episode (if
+        any) and copy it wherever ``save_video`` was asked to save it."""
+        if self._video_writer is not None:
+            self._video_writer.close()
+            self._video_writer = None
+        for path in self._pending_video_paths:
+            shutil.copyfile(self._video_path, path)
+        self._pending_video_paths = []
+        self._video_streamed = False
+    
+    
     def close(self):
         """Close the environment, save data, and release any resources."""
         if self.render_mode == 'saved' and self.output_dir is not None:
-            self.save_video(self.output_dir / 'video.mp4')
\ No newline at end of file
+            self.save_video(self.output_dir / 'video.mp4')
+        self._finish_video_stream()
+        self._renderer = None  # release the rendering context
+
+
+class VectorNeuroMechFlyMuJoCo:
+    """A batch of identical MuJoCo-based NeuroMechFly environments that
+    are stepped in parallel. All environments share one compiled MuJoCo
+    model and each has its own ``mujoco.MjData``; the physics steps are
+    run in a thread pool (MuJoCo releases the GIL while stepping).
+    Rendering is not supported.
+
+    Attributes
+    ----------
+    num_envs : int
+        Number of environments in the batch.
+    env : NeuroMechFlyMuJoCo
+        The (headless) environment defining the model, action space,
+        and observation space of every environment in the batch.
+    action_space : Dict[str, gym.spaces.Box]
+        Action space of the batch. Same as that of a single
+        environment, with a leading dimension of size ``num_envs``.
+    observation_space : Dict[str, gym.spaces.Box]
+        Observation space of the batch. Same as that of a single
+        environment, with a leading dimension of size ``num_envs``.
+    curr_time : np.ndarray
+        The (simulated) time elapsed since the last reset of each
+        environment (in seconds).
+    """
+    def __init__(self,
+                 num_envs: int,
+                 num_threads: Optional[int] = None,
+                 **kwargs: Any) -> None:
+        """Initialize a batch of MuJoCo-based NeuroMechFly environments.
+
+        Parameters
+        ----------
+        num_envs : int
+            Number of environments in the batch.
+        num_threads : int, optional
+            Number of threads used to step the environments. If None,
+            the default of ``concurrent.futures.ThreadPoolExecutor`` is
+            used. By default None
+        **kwargs
+            Arguments passed to ``NeuroMechFlyMuJoCo`` to configure
+            every environment of the batch (``render_mode`` is always
+            'headless').
+        """
+        self.num_envs = num_envs
+        self.env = NeuroMechFlyMuJoCo(render_mode='headless', **kwargs)
+        self.action_space = {
+            k: spaces.Box(low=np.broadcast_to(v.low, (num_envs, *v.shape)),
+                          high=np.broadcast_to(v.high, (num_envs, *v.shape)))
+            for k, v in self.env.action_space.items()
+        }
+        self.observation_space = {
+            k: spaces.Box(low=np.broadcast_to(v.low, (num_envs, *v.shape)),
+                          high=np.broadcast_to(v.high, (num_envs, *v.shape)))
+            for k, v in self.env.observation_space.items()
+        }
+        self.curr_time = np.zeros(num_envs)
+        
+        self._mj_model = self.env._mj_model
+        self._datas = [mujoco.MjData(self._mj_model) for _ in range(num_envs)]
+        self._pool = ThreadPoolExecutor(num_threads)
+        
+        # Indices of the actuators and sensors in the MjData arrays
+        physics = self.env.physics
+        self._actuator_ids = physics.bind(self.env.actuators).element_id
+        self._joint_sensor_idx = physics.model.sensor_adr[
+            physics.bind(self.env.joint_sensors).element_id
+        ]
+        self._body_sensor_slices = [
+            slice(physics.model.sensor_adr[sensor_id],
+                  physics.model.sensor_adr[sensor_id] +
+                  physics.model.sensor_dim[sensor_id])
+            for sensor_id in physics.bind(self.env.body_sensors).element_id
+        ]
+    
+    
+    def reset(self, env_ids: Optional[List[int]] = None
+              ) -> Tuple[ObsType, Dict[str, Any]]:
+        """Reset some or all environments of the batch.
+
+        Parameters
+        ----------
+        env_ids : List[int], optional
+            Indices of the environments to reset. If None, all
+            environments are reset. By default None
+
+        Returns
+        -------
+        ObsType
+            The batched observation of all environments.
+        Dict[str, Any]
+            Any additional information that is not part of the
+            observation. This is an empty dictionary by default.
+        """
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        for i in env_ids:
+            _reset_data(self._mj_model, self._datas[i],
+                        self.env._init_qpos_idx, self.env._init_pose_values)
+            self.curr_time[i] = 0
+        return self._get_observation(), self._get_info()
+    
+    
+    def step(self, action: ObsType
+             ) -> Tuple[ObsType, Dict[str, Any]]:
+        """Step all environments of the batch in parallel.
+
+        Parameters
+        ----------
+        action : ObsType
+            Action dictionary as defined by the batch's action space,
+            ie. the action of each environment stacked along the first
+            dimension.
+
+        Returns
+        -------
+        ObsType
+            The batched observation of all environments.
+        Dict[str, Any]
+            Any additional information that is not part of the
+            observation. This is an empty dictionary by default.
+
+        Raises
+        ------
+        ValueError
+            If the actions do not match the batch's action space.
+        PhysicsError
+            If the physics state of any environment became invalid
+            (like ``check_invalid_state`` in the single environment).
+            All environments are stepped nonetheless.
+        """
+        joint_actions = np.asarray(action['joints'])
+        if joint_actions.shape != self.action_space['joints'].shape:
+            raise ValueError(
+                f'Expected joint actions of shape '
+                f'{self.action_space["joints"].shape}, got '
+                f'{joint_actions.shape}.'
+            )
+        for data, ctrl in zip(self._datas, joint_actions):
+            data.ctrl[self._actuator_ids] = ctrl
+        new_warnings = np.array(list(
+            self._pool.map(self._step_data, self._datas)
+        ))
+        self.curr_time += self.env.timestep * self.env.n_substeps
+        if new_warnings.any():
+            warning_names = list(mujoco.mjtWarning.__members__)
+            invalid_envs = [
+                f'{i} ({", ".join(np.compress(env_warnings, warning_names))})'
+                for i, env_warnings in enumerate(new_warnings)
+                if env_warnings.any()
+            ]
+            raise PhysicsError(
+                'Physics state is invalid in environment(s) '
+                f'{", ".join(invalid_envs)}.'
+            )
+        return self._get_observation(), self._get_info()
+    
+    
+    def _step_data(self, data: mujoco.MjData) -> np.ndarray:
+        """Step one environment. Returns whether each MuJoCo warning
+        was raised during the step."""
+        warnings_before = data.warning.number.copy()
+        _step_physics(self._mj_model, data, self.env.n_substeps)
+        # In the single environment, reading the sensors through the
+        # dm_control bindings after the controls were written triggers a
+        # forward pass. Do the same so that observations (actuator forces)
+        # are identical.
+        mujoco.mj_forward(self._mj_model, data)
+        return data.warning.number > warnings_before
+    
+    
+    def _get_observation(self) -> ObsType:
+        joint_obs = np.empty((self.num_envs, 3, self.env._num_dofs))
+        fly_pos = np.empty((self.num_envs, 4, 3))
+        for i, data in enumerate(self._datas):
+            sensordata = data.sensordata
+            _pack_observation(
+                sensordata[self._joint_sensor_idx],
+                *[sensordata[s] for s in self._body_sensor_slices],
+                joint_obs[i], fly_pos[i]
+            )
+        return {
+            'joints': joint_obs,
+            'fly': fly_pos,
+        }
+    
+    
+    def _get_info(self):
+        return {}
+    
+    
+    def close(self):
+        """Close the environments and release any resources."""
+        self._pool.shutdown()
+        self.env.close()
@@ -18,7 +18,6 @@ setup(
     install_requires=[
         'gymnasium',
         'numpy',
-        'scipy',
         'pyyaml',
         'jupyter',
         'mediapy',
@@ -28,7 +27,7 @@ setup(
         'tqdm'
     ],
     extras_require={
-        'mujoco': ['mujoco', 'dm_control'],
+        'mujoco': ['mujoco', 'dm_control', 'numba'],
         'pybullet': ['pybullet'],
         'doc': ['sphinx', 'furo', 'numpydoc']
     },
@@ -1,12 +1,17 @@
 import unittest
 import tempfile
+import pickle
 import os
 import numpy as np
+import imageio
+from unittest import mock
 import matplotlib.pyplot as plt
 from pathlib import Path
 
 import flygym
-from flygym.envs.nmf_mujoco import NeuroMechFlyMuJoCo
+from flygym.envs.nmf_mujoco import NeuroMechFlyMuJoCo, VectorNeuroMechFlyMuJoCo
+from flygym.envs.nmf_mujoco import _get_video_codec
+from dm_control.rl.control import PhysicsError
 
 
 random_state = np.random.RandomState(0)
@@ -78,12 +83,152 @@ class MuJoCoTest(unittest.TestCase):
                                  terrain='gapped')
         nmf.close()
     
+    def test_headless_pickle(self):
+        nmf = NeuroMechFlyMuJoCo(render_mode='headless')
+        nmf.render()
+        pickle.dumps(nmf)
+        nmf.close()
+    
     def test_blocks_terrain(self):
         out_dir = _temp_base_dir / 'mujoco_blocks_terrain'
         nmf = NeuroMechFlyMuJoCo(render_mode='headless', output_dir=out_dir,
                                  terrain='blocks')
         nmf.close()
 
+    
+    def test_saved_video(self):
+        out_dir = _temp_base_dir / 'mujoco_saved_video'
+        num_steps = 4
+        # (keep_in_memory, max_recorded_frames, expected number of frames)
+        cases = [(True, None, num_steps), (True, 3, 3),
+                 (False, None, num_steps)]
+        for keep_in_memory, max_frames, num_frames in cases:
+            with self.subTest(keep_in_memory=keep_in_memory,
+                              max_recorded_frames=max_frames):
+                video_dir = out_dir / f'{keep_in_memory}_{max_frames}'
+                # small playspeed: render upon every step
+                render_config = {'playspeed': 1e-3,
+                                 'keep_in_memory': keep_in_memory,
+                                 'max_recorded_frames': max_frames}
+                nmf = NeuroMechFlyMuJoCo(render_mode='saved',
+                                         output_dir=video_dir,
+                                         render_config=render_config)
+                action = {'joints': np.zeros(len(nmf.actuators))}
+                with nmf.physics.suppress_physics_errors():
+                    for i in range(num_steps):
+                        nmf.step(action)
+                        nmf.render()
+                        if i == 0:
+                            renderer = nmf._renderer
+                self.assertIs(nmf._renderer, renderer)
+                if keep_in_memory:
+                    self.assertEqual(nmf._frame_i, num_frames)
+                nmf.save_video(video_dir / 'copy.mp4')
+                nmf.close()
+                for path in [video_dir / 'video.mp4', video_dir / 'copy.mp4']:
+                    with imageio.get_reader(path) as reader:
+                        self.assertEqual(reader.count_frames(), num_frames)
+    
+    def test_video_codec_fallback(self):
+        _get_video_codec.cache_clear()
+        try:
+            with mock.patch('subprocess.run', side_effect=OSError):
+                self.assertEqual(_get_video_codec(), 'libx264')
+        finally:
+            _get_video_codec.cache_clear()
+
+    
+    def test_compiled_model_reuse(self):
+        nmf1 = NeuroMechFlyMuJoCo(render_mode='headless')
+        nmf2 = NeuroMechFlyMuJoCo(render_mode='headless')
+        obs1, _ = nmf1.reset()
+        obs2, _ = nmf2.reset()
+        self.assertTrue(np.array_equal(obs1['joints'], obs2['joints']))
+        self.assertTrue(np.array_equal(obs1['fly'], obs2['fly']))
+        # each environment must own its model
+        nmf1.physics.model.opt.gravity = (0, 0, 0)
+        self.assertFalse(np.array_equal(nmf2.physics.model.opt.gravity,
+                                        (0, 0, 0)))
+        nmf1.close()
+        nmf2.close()
+
+    
+    def test_unseeded_terrain_not_reused(self):
+        terrain_config = {'rand_seed': None, 'height_range': (100, 500)}
+        nmf1 = NeuroMechFlyMuJoCo(render_mode='headless', terrain='blocks',
+                                  terrain_config=terrain_config)
+        nmf2 = NeuroMechFlyMuJoCo(render_mode='headless', terrain='blocks',
+                                  terrain_config=terrain_config)
+        self.assertFalse(np.array_equal(nmf1.physics.model.geom_pos,
+                                        nmf2.physics.model.geom_pos))
+        nmf1.close()
+        nmf2.close()
+
+    
+    def test_subclass_model_not_reused(self):
+        class StiffTarsusNMF(NeuroMechFlyMuJoCo):
+            def _set_compliant_Tarsus(self, all_joints, kp=5, **kwargs):
+                super()._set_compliant_Tarsus(all_joints, kp=50, **kwargs)
+        
+        actuator = 'Animat/actuator_position_joint_LFTarsus2'
+        nmf1 = NeuroMechFlyMuJoCo(render_mode='headless')
+        nmf2 = StiffTarsusNMF(render_mode='headless')
+        self.assertEqual(nmf1.physics.model.actuator(actuator).gainprm[0], 5)
+        self.assertEqual(nmf2.physics.model.actuator(actuator).gainprm[0], 50)
+        nmf1.close()
+        nmf2.close()
+
+    
+    def test_substeps(self):
+        nmf1 = NeuroMechFlyMuJoCo(render_mode='headless')
+        nmf2 = NeuroMechFlyMuJoCo(render_mode='headless', n_substeps=2)
+        nmf1.reset()
+        nmf2.reset()
+        action = {'joints': nmf1.physics.bind(nmf1.actuators).ctrl.copy()}
+        for i in range(2):
+            obs1, _ = nmf1.step(action)
+        obs2, _ = nmf2.step(action)
+        self.assertAlmostEqual(nmf1.curr_time, nmf2.curr_time)
+        self.assertTrue(np.allclose(obs1['joints'], obs2['joints']))
+        self.assertTrue(np.allclose(obs1['fly'], obs2['fly']))
+        nmf1.close()
+        nmf2.close()
+        for n_substeps in (0, 1.5):
+            with self.assertRaises(ValueError):
+                NeuroMechFlyMuJoCo(render_mode='headless',
+                                   n_substeps=n_substeps)
+
+    
+    def test_vector_env(self):
+        num_envs = 3
+        nmf = NeuroMechFlyMuJoCo(render_mode='headless')
+        vec_nmf = VectorNeuroMechFlyMuJoCo(num_envs)
+        obs, _ = nmf.reset()
+        vec_obs, _ = vec_nmf.reset()
+        self.assertEqual(vec_obs['joints'].shape,
+                         (num_envs, *nmf.observation_space['joints'].shape))
+        self.assertEqual(vec_obs['fly'].shape,
+                         (num_envs, *nmf.observation_space['fly'].shape))
+        self.assertTrue(np.allclose(vec_obs['joints'][1], obs['joints']))
+        
+        actions = 0.1 * random_state.randn(num_envs, len(nmf.actuators))
+        for i in range(2):
+            obs, _ = nmf.step({'joints': actions[1]})
+            vec_obs, _ = vec_nmf.step({'joints': actions})
+        self.assertTrue(np.allclose(vec_obs['joints'][1], obs['joints']))
+        self.assertTrue(np.allclose(vec_obs['fly'][1], obs['fly']))
+        self.assertFalse(np.allclose(vec_obs['joints'][0], obs['joints']))
+        self.assertTrue(np.allclose(vec_nmf.curr_time, nmf.curr_time))
+        
+        with self.assertRaises(ValueError):
+            vec_nmf.step({'joints': actions[:2]})
+        unstable_actions = actions.copy()
+        unstable_actions[2] = np.nan
+        with self.assertRaises(PhysicsError):
+            vec_nmf.step({'joints': unstable_actions})
+        nmf.close()
+        vec_nmf.close()
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file